@@ -1,82 +1,198 @@
-"""LLM client for streaming SVG generation via LiteLLM."""
+"""LLM client for streaming SVG generation from Ollama (direct) and OpenRouter (via LiteLLM)."""
 
+import asyncio
+import contextlib
 import logging
-from typing import AsyncGenerator
+import time
+from typing import AsyncGenerator, Awaitable, Callable
+
+import httpx
 import litellm
+import orjson
 
 log = logging.getLogger(__name__)
 
+OLLAMA_BASE = "http://localhost:11434"
+OLLAMA_KEEP_ALIVE = "30m"
+# Seconds an unreachable endpoint is skipped by the round-robin
+ENDPOINT_QUARANTINE = 30.0
+
+
+def _text_content(content: str | list[dict]) -> str:
+    """Flatten OpenAI-style content parts into the plain string Ollama expects."""
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") for part in content)
+
+
+class OllamaDirectClient:
+    """Streams from Ollama's /api/chat, parsing NDJSON lines without LiteLLM."""
+
+    def __init__(self, http: httpx.AsyncClient, model: str, max_tokens: int, temperature: float):
+        self.http = http
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    def _build_payload(self, messages: list[dict]) -> bytes:
+        payload = {
+            "model": self.model,
+            "messages": [{"role": m["role"], "content": _text_content(m["content"])} for m in messages],
+            "stream": True,
+            "options": {"temperature": self.temperature, "num_predict": self.max_tokens},
+            # keep_alive holds the model (and its prompt KV cache) in memory between draws
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+        }
+        if "gpt-oss" in self.model.lower():
+            payload["think"] = "low"
+        return orjson.dumps(payload)
+
+    async def stream_chat(self, api_base: str, messages: list[dict]) -> AsyncGenerator[str, None]:
+        """Stream message content; thinking arrives in a separate field and is skipped."""
+        async with self.http.stream(
+            "POST",
+            f"{api_base}/api/chat",
+            content=self._build_payload(messages),
+            headers={"Content-Type": "application/json"},
+        ) as resp:
+            resp.raise_for_status()
+            chunk_count = 0
+            async for line in resp.aiter_lines():
+                if not line:
+                    continue
+                data = orjson.loads(line)
+                if "error" in data:
+                    raise RuntimeError(data["error"])
+                chunk_count += 1
+                content = data.get("message", {}).get("content")
+                if content:
+                    yield content
+                if data.get("done"):
+                    log.info(f"llm finish reason={data.get('done_reason')} chunks={chunk_count}")
+
 
 class LLMClient:
     """Streaming LLM client supporting Ollama and OpenRouter."""
 
+    # One keep-alive connection pool shared by every client instance
+    _http: httpx.AsyncClient | None = None
+
+    # Per-endpoint state shared by every client: a bounded number of generations per endpoint
+    _slots: dict[str, asyncio.Semaphore] = {}
+    _quarantined_until: dict[str, float] = {}
+    _next_endpoint = 0
+
     def __init__(
         self,
         model: str = "gpt-oss:20b",
         provider: str = "ollama",
-        api_base: str = "http://localhost:11434",
+        endpoints: list[str] | None = None,
+        slots_per_endpoint: int = 1,
         max_tokens: int = 100000,
         temperature: float = 0.9,
     ):
         self.provider = provider
         self.model = f"{provider}/{model}"
-        self.api_base = api_base if provider == "ollama" else None
+        self.endpoints = (endpoints or [OLLAMA_BASE]) if provider == "ollama" else []
+        self.slots_per_endpoint = slots_per_endpoint
         self.max_tokens = max_tokens
         self.temperature = temperature
+        if LLMClient._http is None:
+            LLMClient._http = httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                # Generations may stream for minutes, but an unreachable host should fail fast
+                timeout=httpx.Timeout(None, connect=5.0),
+            )
+            litellm.aclient_session = LLMClient._http
+        self._ollama = None
+        if provider == "ollama":
+            self._ollama = OllamaDirectClient(LLMClient._http, model, max_tokens, temperature)
 
-    def _build_extra_body(self) -> dict | None:
-        """Configure provider-specific options."""
-        if self.provider != "ollama":
-            return None
-        extra_body = {"hidethinking": True}
-        if "gpt-oss" in self.model.lower():
-            extra_body["think"] = "low"
-        return extra_body
+    @classmethod
+    async def aclose(cls):
+        """Close the shared connection pool."""
+        if cls._http is not None:
+            await cls._http.aclose()
+            cls._http = None
+            litellm.aclient_session = None
 
-    async def stream_completion(self, messages: list[dict]) -> AsyncGenerator[str, None]:
-        """Stream text chunks from LLM."""
-        try:
-            kwargs = {
-                "model": self.model,
-                "messages": messages,
-                "max_tokens": self.max_tokens,
-                "temperature": self.temperature,
-                "stream": True,
-            }
-            if self.api_base:
-                kwargs["api_base"] = self.api_base
-            extra_body = self._build_extra_body()
-            if extra_body:
-                kwargs["extra_body"] = extra_body
-
-            log.info(f"llm start model={self.model} max_tokens={self.max_tokens}")
-            response = await litellm.acompletion(**kwargs)
+    def _pick_endpoint(self) -> str:
+        """Pick an idle healthy endpoint, else round-robin over the healthy ones (or all if none are)."""
+        now = time.monotonic()
+        healthy = [url for url in self.endpoints if LLMClient._quarantined_until.get(url, 0.0) <= now]
+        candidates = healthy or self.endpoints
+        for url in candidates:
+            slot = LLMClient._slots.get(url)
+            if slot is None or not slot.locked():
+                return url
+        url = candidates[LLMClient._next_endpoint % len(candidates)]
+        LLMClient._next_endpoint += 1
+        return url
 
-            chunk_count = 0
-            async for chunk in response:
-                chunk_count += 1
-                content = self._extract_content(chunk)
-                if content:
-                    yield content
-                # Check for finish reason
-                if hasattr(chunk, "choices") and chunk.choices:
-                    finish = chunk.choices[0].finish_reason
-                    if finish:
-                        log.info(f"llm finish reason={finish} chunks={chunk_count}")
-            log.info(f"llm stream ended chunks={chunk_count}")
-        except litellm.exceptions.ServiceUnavailableError:
-            raise ConnectionError(f"{self.provider} unavailable")
-        except Exception as e:
-            log.exception(f"llm error: {e}")
-            raise ConnectionError(f"LLM error: {e}")
-
-    def _extract_content(self, chunk) -> str:
-        """Extract text from various chunk formats."""
+    def _slot(self, api_base: str | None):
+        """Return the semaphore guarding an endpoint (no limit without one)."""
+        if api_base is None:
+            return contextlib.nullcontext()
+        slot = LLMClient._slots.get(api_base)
+        if slot is None:
+            slot = LLMClient._slots[api_base] = asyncio.Semaphore(self.slots_per_endpoint)
+        return slot
+
+    async def stream_completion(
+        self, messages: list[dict], on_queued: Callable[[], Awaitable] | None = None
+    ) -> AsyncGenerator[str, None]:
+        """Stream text chunks from LLM, awaiting on_queued first if every slot is busy."""
+        api_base = self._pick_endpoint() if self.endpoints else None
+        slot = self._slot(api_base)
+        if on_queued is not None and api_base is not None and slot.locked():
+            await on_queued()
+        async with slot:
+            try:
+                log.info(f"llm start model={self.model} api_base={api_base} max_tokens={self.max_tokens}")
+                if self._ollama:
+                    chunks = self._ollama.stream_chat(api_base, messages)
+                else:
+                    chunks = self._stream_litellm(messages)
+                async with contextlib.aclosing(chunks):
+                    async for content in chunks:
+                        yield content
+                log.info("llm stream ended")
+            except (
+                httpx.ConnectError,
+                httpx.ConnectTimeout,
+                litellm.exceptions.ServiceUnavailableError,
+                litellm.exceptions.APIConnectionError,
+            ):
+                if api_base:
+                    LLMClient._quarantined_until[api_base] = time.monotonic() + ENDPOINT_QUARANTINE
+                    log.warning(f"llm endpoint {api_base} quarantined for {ENDPOINT_QUARANTINE:.0f}s")
+                raise ConnectionError(f"{self.provider} unavailable")
+            except Exception as e:
+                log.exception(f"llm error: {e}")
+                raise ConnectionError(f"LLM error: {e}")
+
+    async def _stream_litellm(self, messages: list[dict]) -> AsyncGenerator[str, None]:
+        response = await litellm.acompletion(
+            model=self.model,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=True,
+        )
+        chunk_count = 0
+        extract = self._extract
+        async for chunk in response:
+            chunk_count += 1
+            content, finish = extract(chunk)
+            if content:
+                yield content
+            if finish:
+                log.info(f"llm finish reason={finish} chunks={chunk_count}")
+
+    def _extract(self, chunk) -> tuple[str, str | None]:
+        """Extract (text, finish_reason) from a streaming chunk."""
         try:
-            if hasattr(chunk, "choices") and chunk.choices:
-                delta = chunk.choices[0].delta
-                if hasattr(delta, "content") and delta.content:
-                    return delta.content
-            return ""
-        except (AttributeError, KeyError, IndexError):
-            return ""
+            choice = chunk.choices[0]
+            return choice.delta.content or "", choice.finish_reason
+        except (AttributeError, IndexError, TypeError):
+            return "", None
@@ -3,25 +3,68 @@
 import asyncio
 import logging
 import os
-import re
 import time
 import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from pathlib import Path
 
 import httpx
+import orjson
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 
-from llm import LLMClient
+from llm import OLLAMA_BASE, LLMClient
 
-OLLAMA_BASE = "http://localhost:11434"
+# Comma-separated Ollama hosts; draws are spread across them round-robin
+OLLAMA_ENDPOINTS = [
+    url.strip().rstrip("/") for url in os.environ.get("OLLAMA_ENDPOINTS", OLLAMA_BASE).split(",") if url.strip()
+] or [OLLAMA_BASE]
 OPENROUTER_MODELS = ["google/gemini-3-pro-preview", "google/gemini-2.0-flash-001"]
+MODELS_CACHE_TTL = 30.0
+
+# Concurrent generations per Ollama endpoint; match the server's OLLAMA_NUM_PARALLEL
+LLM_SLOTS = int(os.environ.get("LLM_SLOTS", "1"))
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 log = logging.getLogger(__name__)
 
-app = FastAPI()
+# Client for Ollama's REST API (model listing across OLLAMA_ENDPOINTS); closed on shutdown
+_http = httpx.AsyncClient(timeout=5.0)
+
+# (fetched_at, response) for /api/models
+_models_cache: tuple[float, dict] | None = None
+
+# LLM clients reused across requests, keyed by (provider, model); the model name
+# comes from the client, so the cache is bounded (LRU)
+CLIENT_CACHE_SIZE = 16
+_clients: OrderedDict[tuple[str, str], LLMClient] = OrderedDict()
+
+
+def get_llm_client(model: str, provider: str) -> LLMClient:
+    """Return the cached client for a model, creating it on first use."""
+    key = (provider, model)
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = LLMClient(
+            model=model, provider=provider, endpoints=OLLAMA_ENDPOINTS, slots_per_endpoint=LLM_SLOTS
+        )
+        if len(_clients) > CLIENT_CACHE_SIZE:
+            _clients.popitem(last=False)
+    else:
+        _clients.move_to_end(key)
+    return client
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await _http.aclose()
+    await LLMClient.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 SYSTEM_PROMPT = """You are a master SVG sketch artist. Output ONLY SVG code.
 - Begin with <svg> and end with </svg>
@@ -40,61 +83,221 @@ IMPORTANT: Create the most detailed, expressive drawing possible. Fill your enti
 
 Never stop early. Keep drawing until you've created a rich, detailed masterpiece."""
 
+# Static prefix shared by every draw; marked cacheable so providers can reuse the prefill
+SYSTEM_MESSAGES = [
+    {
+        "role": "system",
+        "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+    },
+]
+
 # Timeouts (seconds) - generous for local LLMs
 START_CHUNK_DEADLINE = 60.0
 IDLE_CHUNK_GAP = 60.0
 REQUEST_HARD_LIMIT = 300.0
 MAX_PROMPT_LEN = 512
 
+# Streamed chunks are coalesced into at most one frame per interval
+CHUNK_FLUSH_INTERVAL = 0.02
 
-def sanitize_prompt(prompt: str) -> str:
-    """Trim and remove control characters."""
-    prompt = prompt.strip()
-    prompt = re.sub(r"[\x00-\x1f\x7f-\x9f]", "", prompt)
-    return prompt
+# Stop reading from the LLM once this many characters wait on a slow client,
+# and resume when the backlog falls to the low-water mark
+BUFFER_HIGH_WATER = 256 * 1024
+BUFFER_LOW_WATER = 64 * 1024
 
+# Completed streams replayed for repeated prompts, keyed by (provider, model, prompt)
+RESPONSE_CACHE_SIZE = 256
+# Cached drawings are stored joined and replayed in slices of this many characters
+REPLAY_SLICE = 4096
+_response_cache: OrderedDict[tuple[str, str, str], str] = OrderedDict()
 
-async def handle_draw(websocket: WebSocket, prompt: str, req_id: str, model: str, provider: str, cancel_event: asyncio.Event):
-    """Handle a single draw request with streaming."""
-    start_time = time.monotonic()
-    first_chunk_time = None
-    cancelled = False
-    error_reason = None
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": f"Draw: {prompt}"},
-    ]
+async def send_message(websocket: WebSocket, msg: dict):
+    """Send a JSON text frame, serialized with orjson."""
+    await websocket.send_text(orjson.dumps(msg).decode())
 
-    llm_client = LLMClient(model=model, provider=provider)
-    await websocket.send_json({"type": "start", "id": req_id})
+
+# str.translate deletion table for C0/C1 control characters
+_CTRL_TBL = dict.fromkeys([*range(0x00, 0x20), *range(0x7F, 0xA0)])
+
+
+def sanitize_prompt(prompt: str) -> str:
+    """Trim and remove control characters."""
+    return prompt.strip().translate(_CTRL_TBL)
+
+
+async def replay_chunks(text: str):
+    """Yield a cached drawing in slices, letting the event loop run between sends."""
+    for i in range(0, len(text), REPLAY_SLICE):
+        yield text[i:i + REPLAY_SLICE]
+        await asyncio.sleep(0)
+
+
+class ChunkBatcher:
+    """Coalesce streamed chunks into at most one WebSocket frame per CHUNK_FLUSH_INTERVAL."""
+
+    def __init__(self, websocket: WebSocket, req_id: str):
+        self.websocket = websocket
+        self.req_id = req_id
+        # Constant part of every chunk frame, serialized once per request
+        self.frame_prefix = b'{"type":"chunk","id":' + orjson.dumps(req_id) + b',"data":'
+        self.pending: list[str] = []
+        self.buffered = 0
+        self.ready = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.closing = False
+        self.task = asyncio.create_task(self._flush_loop())
+
+    @property
+    def failed(self) -> bool:
+        """True if the flush loop stopped before close() (client disconnected)."""
+        return self.task.done() and not self.closing
+
+    async def push(self, chunk: str, cancel_wait: asyncio.Future):
+        """Buffer a chunk; if the client is far behind, wait until it catches up or the draw is cancelled."""
+        self.pending.append(chunk)
+        self.buffered += len(chunk)
+        self.ready.set()
+        if self.buffered > BUFFER_HIGH_WATER:
+            self.drained.clear()
+            drained_wait = asyncio.ensure_future(self.drained.wait())
+            try:
+                await asyncio.wait({drained_wait, cancel_wait}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                drained_wait.cancel()
+
+    async def close(self):
+        """Send any buffered chunks and stop the flush loop."""
+        self.closing = True
+        self.ready.set()
+        await self.task
+
+    def discard(self):
+        """Stop the flush loop, dropping anything still buffered."""
+        if not self.task.done():
+            self.task.cancel()
+        elif not self.task.cancelled():
+            self.task.exception()  # Mark retrieved; failures are logged by the caller
+
+    async def _flush_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                closing = self.closing
+                if self.pending:
+                    data = "".join(self.pending)
+                    self.pending.clear()
+                    # buffered counts unsent characters (pending plus the rest of data);
+                    # a large backlog goes out in low-water-sized frames so push() resumes
+                    # once it falls to the low-water mark, not when it is fully written
+                    for i in range(0, len(data), BUFFER_LOW_WATER):
+                        part = data[i:i + BUFFER_LOW_WATER]
+                        frame = self.frame_prefix + orjson.dumps(part) + b"}"
+                        await self.websocket.send_text(frame.decode())
+                        self.buffered -= len(part)
+                        if self.buffered <= BUFFER_LOW_WATER:
+                            self.drained.set()
+                if closing:
+                    return
+                await asyncio.sleep(CHUNK_FLUSH_INTERVAL)
+        finally:
+            self.drained.set()  # Never leave push() waiting on a dead loop
+
+
+async def handle_draw(
+    websocket: WebSocket,
+    prompt: str,
+    req_id: str,
+    model: str,
+    provider: str,
+    cancel_event: asyncio.Event,
+    previous: asyncio.Task | None = None,
+):
+    """Handle a single draw request with streaming."""
+    start_time = time.monotonic()
 
     async def safe_send(msg):
         try:
-            await websocket.send_json(msg)
+            await send_message(websocket, msg)
         except Exception:
             pass  # Client disconnected
 
+    if previous is not None:
+        # Let the cancelled draw release its LLM slot before this one queues for it
+        await asyncio.wait({previous})
+        # A newer draw may have superseded this one while it waited
+        if cancel_event.is_set():
+            await safe_send({"type": "cancelled", "id": req_id})
+            log.info(f"req={req_id[:8]} cancelled before start")
+            return
+
+    first_chunk_time = None
+    cancelled = False
+    error_reason = None
+
+    cache_key = (provider, model, prompt.lower())
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        _response_cache.move_to_end(cache_key)
+        chunk_stream = replay_chunks(cached)
+        received = None
+    else:
+        messages = [*SYSTEM_MESSAGES, {"role": "user", "content": "Draw: " + prompt}]
+        chunk_stream = get_llm_client(model, provider).stream_completion(
+            messages, on_queued=lambda: safe_send({"type": "queued", "id": req_id})
+        )
+        received = []
+
+    await send_message(websocket, {"type": "start", "id": req_id})
+
+    batcher = ChunkBatcher(websocket, req_id)
+    # Race each chunk against cancellation so a slow or queued stream stops immediately
+    cancel_wait = asyncio.create_task(cancel_event.wait())
+    next_chunk = None
     try:
         chunks_sent = 0
-        async for chunk in llm_client.stream_completion(messages):
-            if cancel_event.is_set():
+        push = batcher.push
+        while True:
+            next_chunk = asyncio.ensure_future(anext(chunk_stream))
+            done, _ = await asyncio.wait({next_chunk, cancel_wait}, return_when=asyncio.FIRST_COMPLETED)
+            if cancel_wait in done:
                 cancelled = True
-                await safe_send({"type": "cancelled", "id": req_id})
+                # A stalled client would block the notice (and the next draw behind it)
+                if batcher.drained.is_set():
+                    await safe_send({"type": "cancelled", "id": req_id})
                 log.info(f"req={req_id[:8]} cancelled after {chunks_sent} chunks")
                 return
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                break
 
             if first_chunk_time is None:
                 first_chunk_time = time.monotonic() - start_time
 
-            try:
-                await websocket.send_json({"type": "chunk", "id": req_id, "data": chunk})
-                chunks_sent += 1
-            except Exception:
+            if received is not None:
+                received.append(chunk)
+
+            if batcher.failed:
                 log.info(f"req={req_id[:8]} client disconnected after {chunks_sent} chunks")
                 return
+            await push(chunk, cancel_wait)
+            chunks_sent += 1
+
+        try:
+            await batcher.close()
+        except Exception:
+            log.info(f"req={req_id[:8]} client disconnected after {chunks_sent} chunks")
+            return
 
-        log.info(f"req={req_id[:8]} stream done, sent {chunks_sent} chunks")
+        if received is not None:
+            _response_cache[cache_key] = "".join(received)
+            if len(_response_cache) > RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
+
+        log.info(f"req={req_id[:8]} stream done, sent {chunks_sent} chunks cached={received is None}")
         await safe_send({"type": "done", "id": req_id})
 
     except ConnectionError as e:
@@ -105,6 +308,12 @@ async def handle_draw(websocket: WebSocket, prompt: str, req_id: str, model: str
         await safe_send({"type": "error", "id": req_id, "message": "An error occurred."})
         log.exception(f"req={req_id[:8]} error")
     finally:
+        cancel_wait.cancel()
+        if next_chunk is not None and not next_chunk.done():
+            next_chunk.cancel()
+            await asyncio.wait({next_chunk})
+        batcher.discard()
+        await chunk_stream.aclose()  # Free the endpoint slot now, not at garbage collection
         total_duration = time.monotonic() - start_time
         log.info(f"req={req_id[:8]} first_chunk_ms={int(first_chunk_time*1000) if first_chunk_time else None} total_ms={int(total_duration*1000)} cancelled={cancelled} error={error_reason}")
 
@@ -116,7 +325,7 @@ async def websocket_draw(websocket: WebSocket):
     log.info("ws connect")
 
     current_task: asyncio.Task | None = None
-    cancel_event = asyncio.Event()
+    cancel_event: asyncio.Event | None = None
 
     try:
         while True:
@@ -124,13 +333,11 @@ async def websocket_draw(websocket: WebSocket):
             msg_type = data.get("type")
 
             if msg_type == "ping":
-                await websocket.send_json({"type": "pong"})
+                await send_message(websocket, {"type": "pong"})
 
             elif msg_type == "cancel":
                 if current_task and not current_task.done():
                     cancel_event.set()
-                    await current_task
-                    cancel_event.clear()
 
             elif msg_type == "draw":
                 prompt = sanitize_prompt(data.get("prompt", ""))
@@ -139,21 +346,24 @@ async def websocket_draw(websocket: WebSocket):
                 provider = data.get("provider", "ollama")
 
                 if not prompt:
-                    await websocket.send_json({"type": "error", "id": req_id, "message": "Prompt cannot be empty."})
+                    await send_message(websocket, {"type": "error", "id": req_id, "message": "Prompt cannot be empty."})
                     continue
 
                 if len(prompt) > MAX_PROMPT_LEN:
-                    await websocket.send_json({"type": "error", "id": req_id, "message": f"Prompt too long (max {MAX_PROMPT_LEN} chars)."})
+                    await send_message(websocket, {"type": "error", "id": req_id, "message": f"Prompt too long (max {MAX_PROMPT_LEN} chars)."})
                     continue
 
-                # Cancel existing task
+                # Cancel existing task without waiting; the new task waits for its teardown
+                previous = None
                 if current_task and not current_task.done():
                     cancel_event.set()
-                    await current_task
-                    cancel_event.clear()
+                    previous = current_task
 
-                # Start new task
-                current_task = asyncio.create_task(handle_draw(websocket, prompt, req_id, model, provider, cancel_event))
+                # Start new task with its own cancel event
+                cancel_event = asyncio.Event()
+                current_task = asyncio.create_task(
+                    handle_draw(websocket, prompt, req_id, model, provider, cancel_event, previous)
+                )
 
     except WebSocketDisconnect:
         log.info("ws disconnect")
@@ -172,25 +382,37 @@ async def websocket_draw(websocket: WebSocket):
 @app.get("/api/models")
 async def list_models():
     """Fetch available models from Ollama and OpenRouter."""
+    global _models_cache
+    if _models_cache and time.monotonic() - _models_cache[0] < MODELS_CACHE_TTL:
+        return _models_cache[1]
+
     models = []
+    ollama_ok = False
 
-    # Fetch Ollama models
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{OLLAMA_BASE}/api/tags", timeout=5.0)
+    # Fetch Ollama models from the first endpoint that answers
+    for url in OLLAMA_ENDPOINTS:
+        try:
+            resp = await _http.get(f"{url}/api/tags")
             resp.raise_for_status()
             data = resp.json()
-            for m in data.get("models", []):
-                models.append({"name": m["name"], "provider": "ollama"})
-    except Exception as e:
-        log.warning(f"Failed to fetch Ollama models: {e}")
+        except Exception as e:
+            log.warning(f"Failed to fetch Ollama models from {url}: {e}")
+            continue
+        for m in data.get("models", []):
+            models.append({"name": m["name"], "provider": "ollama"})
+        ollama_ok = True
+        break
 
     # Add OpenRouter models if API key exists
     if os.environ.get("OPENROUTER_API_KEY"):
         for m in OPENROUTER_MODELS:
             models.append({"name": m, "provider": "openrouter"})
 
-    return {"models": models}
+    result = {"models": models}
+    # Don't cache a failed lookup, so models appear as soon as Ollama is up
+    if ollama_ok:
+        _models_cache = (time.monotonic(), result)
+    return result
 
 
 # Static files
@@ -119,7 +119,7 @@ class DrawingApp {
     }
 
     startGenerating() {
-        if (this.state === 'thinking') {
+        if (this.state === 'thinking' || this.state === 'queued') {
             this.state = 'generating';
             this.doodle.clear();
         }
@@ -145,6 +145,9 @@ class DrawingApp {
         if (!this.startTime) return;
         const elapsed = ((Date.now() - this.startTime) / 1000).toFixed(1);
         switch (this.state) {
+            case 'queued':
+                this.setStatus(`Waiting for a free slot... ${elapsed}s`);
+                break;
             case 'thinking':
                 this.setStatus(`Thinking... ${elapsed}s`);
                 break;
@@ -216,6 +219,12 @@ class DrawingApp {
                 this.setStatus('');
                 break;
 
+            case 'queued':
+                if (this.state === 'thinking') {
+                    this.state = 'queued';
+                }
+                break;
+
             case 'chunk':
                 this.startGenerating();
                 console.log('[chunk]', msg.data);